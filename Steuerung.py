@@ -3,8 +3,23 @@ import time
 import sys
 import tty
 import termios
-import threading
 import subprocess
+import ctypes
+import ctypes.util
+import atexit
+import os
+import contextlib
+import itertools
+import math
+import logging
+import select
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+LOG = logging.getLogger(__name__)
 
 Kamera_Script = "/home/jugendforscht26/RasberryPi2/Kamera.py"
 GPIO.setmode(GPIO.BCM)
@@ -48,111 +63,462 @@ Kategorie_zu_Positonen = {
     "trash": 4,
 }
 
-SEQUENCES = {
-    "full": FULL_STEP,
-    "half": HALF_STEP,
+FULL_STEP_REV = FULL_STEP[::-1]
+HALF_STEP_REV = HALF_STEP[::-1]
+
+DIRECTED_SEQUENCES = {
+    ("full", True): FULL_STEP,
+    ("full", False): FULL_STEP_REV,
+    ("half", True): HALF_STEP,
+    ("half", False): HALF_STEP_REV,
 }
 
+SPIN_NS = 500_000
+SLEEP_MIN_NS = 2_000_000
+
+STOP_KEYS = ("s",)
+POLL_EVERY = 10
+
+WAVE_CBS_PER_PULSE = 3
+
+# Am besten mit "isolcpus=3 nohz_full=3" in /boot/cmdline.txt booten.
+RT_CPU = 3
+RT_PRIORITY = 80
+
+CLOCK_MONOTONIC = time.CLOCK_MONOTONIC
+TIMER_ABSTIME = 1
+EINTR = 4
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError as exc:
+        LOG.debug("libc nicht ladbar: %s", exc)
+        return None
+
+
+def _load_clock_nanosleep():
+    try:
+        func = _libc.clock_nanosleep
+    except AttributeError as exc:
+        LOG.debug("clock_nanosleep nicht verfügbar, nutze time.sleep: %s", exc)
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(Timespec), ctypes.POINTER(Timespec)]
+    func.restype = ctypes.c_int
+    return func
+
+
+_libc = _load_libc()
+_clock_nanosleep = _load_clock_nanosleep()
+
+
+def lock_memory():
+    if _libc is None:
+        return
+    if _libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        LOG.debug("mlockall fehlgeschlagen: %s", os.strerror(ctypes.get_errno()))
+
+
+def sleep_until(deadline_ns):
+    if _clock_nanosleep is None:
+        remaining = deadline_ns - time.monotonic_ns()
+        if remaining > 0:
+            time.sleep(remaining / 1e9)
+        return
+
+    deadline = Timespec(*divmod(deadline_ns, 1_000_000_000))
+    while _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, deadline, None) == EINTR:
+        pass
+
+
+def precise_sleep_until(deadline_ns):
+    now = time.monotonic_ns
+    if deadline_ns - now() >= SLEEP_MIN_NS:
+        sleep_until(deadline_ns - SPIN_NS)
+    while now() < deadline_ns:
+        pass
+
+
+def ramp_delays(steps, v_start, v_cruise, accel):
+    if v_start <= 0 or v_cruise <= 0:
+        raise ValueError("v_start und v_cruise müssen positiv sein")
+    if v_start < v_cruise and accel <= 0:
+        raise ValueError("accel muss positiv sein")
+
+    ramp = []
+    speed = v_start
+    while speed < v_cruise and len(ramp) < steps // 2:
+        next_speed = min(math.sqrt(speed ** 2 + 2 * accel), v_cruise)
+        ramp.append(int(2e9 / (speed + next_speed)))
+        speed = next_speed
+
+    cruise = [int(1e9 / min(speed, v_cruise))] * (steps - 2 * len(ramp))
+    return ramp + cruise + ramp[::-1]
+
+
+@contextlib.contextmanager
+def realtime():
+    try:
+        old_affinity = os.sched_getaffinity(0)
+        old_policy = os.sched_getscheduler(0)
+        old_param = os.sched_getparam(0)
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+        enabled = True
+    except (AttributeError, OSError) as exc:
+        LOG.debug("Keine Echtzeit-Priorität: %s", exc)
+        enabled = False
+
+    if not enabled:
+        yield
+        return
+
+    try:
+        os.sched_setaffinity(0, {RT_CPU})
+    except OSError as exc:
+        LOG.debug("CPU %d nicht verfügbar: %s", RT_CPU, exc)
+
+    try:
+        yield
+    finally:
+        os.sched_setscheduler(0, old_policy, old_param)
+        os.sched_setaffinity(0, old_affinity)
+
+
+class MotionAborted(Exception):
+    pass
+
+
+def run_steps(pins, rows, delays_ns):
+    output = GPIO.output
+    wait = precise_sleep_until
+    check_stop = stop_requested
+    done = 0
+    with realtime():
+        deadline = time.monotonic_ns()
+        for row, delay_ns in zip(rows, delays_ns):
+            deadline += delay_ns
+            output(pins, row)
+            done += 1
+            if done % POLL_EVERY == 0 and check_stop():
+                break
+            wait(deadline)
+    return done
+
+
+def connect_pigpio():
+    if pigpio is None:
+        return None
+    pi = pigpio.pi(show_errors=False)
+    if not pi.connected:
+        LOG.debug("pigpiod nicht erreichbar, nutze Software-Timing")
+        return None
+    return pi
+
+
+PI = connect_pigpio()
+
+
+def cleanup():
+    if PI is not None:
+        PI.wave_tx_stop()
+        PI.stop()
+    GPIO.cleanup()
+
+
+atexit.register(cleanup)
+
+
+@contextlib.contextmanager
+def wave_session():
+    waves = []
+    PI.wave_add_new()
+    try:
+        yield waves
+    finally:
+        if PI.wave_tx_busy():
+            PI.wave_tx_stop()
+        for wave in waves:
+            PI.wave_delete(wave)
+
+
+def wait_for_wave(steps, delay_us):
+    start = time.monotonic_ns()
+    while PI.wave_tx_busy():
+        if stop_requested():
+            return min(steps, (time.monotonic_ns() - start) // (delay_us * 1000) + 1)
+        time.sleep(0.01)
+    return steps
+
+
+def play_wave(pulses, delay_us):
+    with wave_session() as waves:
+        PI.wave_add_generic(pulses)
+        waves.append(PI.wave_create())
+        PI.wave_send_once(waves[-1])
+        return wait_for_wave(len(pulses), delay_us)
+
 
 class StepperMotor:
 
     def __init__(self, pins, name="Motor", steps_per_rev=200, gear_ratio=1.0):
-        self.pins = pins
+        self.pins = tuple(pins)
         self.name = name
         self.steps_per_rev = steps_per_rev
         self.gear_ratio = gear_ratio
-        self.current_position = 0.0
-
-        for pin in self.pins:
-            GPIO.setup(pin, GPIO.OUT)
-            GPIO.output(pin, 0)
+        self._rev_half_steps = round(2 * steps_per_rev * gear_ratio)
+        self._position = 0
+        self._sequences = {
+            key: [tuple(step) for step in sequence]
+            for key, sequence in DIRECTED_SEQUENCES.items()
+        }
+        self._masks = {
+            key: [self._step_masks(step) for step in sequence]
+            for key, sequence in self._sequences.items()
+        }
+
+        GPIO.setup(self.pins, GPIO.OUT, initial=GPIO.LOW)
 
     def _set_step(self, step):
+        GPIO.output(self.pins, step)
+
+    def _step_masks(self, step):
+        set_mask = clr_mask = 0
         for pin, value in zip(self.pins, step):
-            GPIO.output(pin, value)
+            if value:
+                set_mask |= 1 << pin
+            else:
+                clr_mask |= 1 << pin
+        return set_mask, clr_mask
 
-    def _get_sequence(self, mode):
-        return SEQUENCES.get(mode, FULL_STEP)
+    def get_sequence(self, mode, clockwise=True):
+        return self._sequences.get((mode, clockwise), self._sequences[("full", clockwise)])
 
-    def rotate_steps(self, steps, delay=0.005, clockwise=True, mode="full"):
-        sequence = self._get_sequence(mode)
-        seq_len = len(sequence)
+    def get_masks(self, mode, clockwise=True):
+        return self._masks.get((mode, clockwise), self._masks[("full", clockwise)])
 
-        for i in range(steps):
-            index = i % seq_len
-            if not clockwise:
-                index = seq_len - 1 - index
-            self._set_step(sequence[index])
-            time.sleep(delay)
+    def rotate_steps(self, steps, delay=0.005, clockwise=True, mode="full"):
+        if PI is not None and steps > 0:
+            done = self._rotate_wave(self.get_masks(mode, clockwise), steps, delay)
+        else:
+            sequence = self.get_sequence(mode, clockwise)
+            done = run_steps(self.pins, itertools.cycle(sequence), itertools.repeat(int(delay * 1e9), steps))
+        self._finish_move(done, steps, clockwise, mode)
+
+    def rotate_accel(self, steps, v_start=200, v_cruise=500, accel=2000, clockwise=True, mode="full"):
+        sequence = self.get_sequence(mode, clockwise)
+        done = run_steps(self.pins, itertools.cycle(sequence), ramp_delays(steps, v_start, v_cruise, accel))
+        self._finish_move(done, steps, clockwise, mode)
+
+    def rotate_ramp(self, steps, delay_start=0.010, delay_min=0.001, accel_steps=40, clockwise=True, mode="full"):
+        if delay_start <= 0 or delay_min <= 0 or accel_steps <= 0:
+            raise ValueError("delay_start, delay_min und accel_steps müssen positiv sein")
+        v_start = 1.0 / delay_start
+        v_cruise = 1.0 / delay_min
+        accel = (v_cruise ** 2 - v_start ** 2) / (2 * accel_steps)
+        self.rotate_accel(steps, v_start, v_cruise, accel, clockwise, mode)
+
+    def _finish_move(self, done, steps, clockwise, mode):
+        self.update_position(done, clockwise, mode)
+        if done < steps:
+            raise MotionAborted(self.name)
+
+    def _rotate_wave(self, masks, steps, delay):
+        delay_us = int(delay * 1e6)
+        pulses = [pigpio.pulse(set_mask, clr_mask, delay_us) for set_mask, clr_mask in masks]
+        loops, rest = divmod(steps, len(masks))
+
+        with wave_session() as waves:
+            chain = []
+            if loops:
+                PI.wave_add_generic(pulses)
+                waves.append(PI.wave_create())
+                chain += [255, 0, waves[-1], 255, 1, loops & 0xFF, loops >> 8]
+            if rest:
+                PI.wave_add_generic(pulses[:rest])
+                waves.append(PI.wave_create())
+                chain.append(waves[-1])
+
+            PI.wave_chain(chain)
+            return wait_for_wave(steps, delay_us)
+
+    @staticmethod
+    def _half_steps_per_step(mode):
+        return 1 if mode == "half" else 2
+
+    def deg_to_steps(self, degrees, mode="full"):
+        return int(degrees * self._rev_half_steps) // (360 * self._half_steps_per_step(mode))
+
+    def steps_to_deg(self, steps, mode="full"):
+        return steps * self._half_steps_per_step(mode) * 360.0 / self._rev_half_steps
+
+    @property
+    def current_position(self):
+        return self.steps_to_deg(self._position, "half")
+
+    @current_position.setter
+    def current_position(self, degrees):
+        self._position = self.deg_to_steps(degrees, "half") % self._rev_half_steps
+
+    def update_position(self, steps, clockwise, mode="full"):
+        half_steps = steps * self._half_steps_per_step(mode)
+        if not clockwise:
+            half_steps = -half_steps
+        self._position = (self._position + half_steps) % self._rev_half_steps
+
+    def plan_move(self, position_num, mode="full"):
+        target = self.deg_to_steps(POSITIONS[position_num], "half")
+        diff = target - self._position
+
+        half_rev = self._rev_half_steps // 2
+        if diff > half_rev:
+            diff -= self._rev_half_steps
+        elif diff < -half_rev:
+            diff += self._rev_half_steps
 
-        degrees = (steps / (self.steps_per_rev * self.gear_ratio)) * 360.0
-        direction = 1 if clockwise else -1
-        self.current_position = (self.current_position + direction * degrees) % 360
+        clockwise = diff >= 0
+        steps = abs(diff) // self._half_steps_per_step(mode)
+        return steps, clockwise
 
     def move_to_position(self, position_num, delay=0.005, mode="full"):
         if position_num not in POSITIONS:
             return
 
-        target = POSITIONS[position_num]
-        diff = target - self.current_position
-
-        if diff > 180:
-            diff -= 360
-        elif diff < -180:
-            diff += 360
-
-        clockwise = diff >= 0
-        degrees_to_move = abs(diff)
-
-        multiplier = 2 if mode == "half" else 1
-        steps = int((degrees_to_move / 360.0) * self.steps_per_rev * multiplier * self.gear_ratio)
-
+        steps, clockwise = self.plan_move(position_num, mode)
         if steps > 0:
             self.rotate_steps(steps, delay, clockwise, mode)
 
-        self.current_position = target
-
     def move_to_home(self, delay=0.005, mode="full"):
         self.move_to_position(0, delay, mode)
 
     def stop(self):
-        for pin in self.pins:
-            GPIO.output(pin, 0)
+        GPIO.output(self.pins, GPIO.LOW)
 
     def hold(self):
-        self._set_step(FULL_STEP[0])
+        self._set_step(self.get_sequence("full")[0])
 
     def reset_position(self):
-        self.current_position = 0.0
-
+        self._position = 0
+
+
+def rotate_motors_together(motors, steps_list, clockwise_list, delay=0.005, mode="full"):
+    moves = [
+        (motor, steps, clockwise)
+        for motor, steps, clockwise in zip(motors, steps_list, clockwise_list)
+        if steps > 0
+    ]
+    if not moves:
+        return
+
+    total = max(steps for _, steps, _ in moves)
+    done = None
+    if PI is not None and total * WAVE_CBS_PER_PULSE <= PI.wave_get_max_cbs():
+        pulses = []
+        delay_us = int(delay * 1e6)
+        masks = [(motor.get_masks(mode, clockwise), steps) for motor, steps, clockwise in moves]
+        for i in range(total):
+            set_mask = clr_mask = 0
+            for motor_masks, steps in masks:
+                step_set, step_clr = motor_masks[min(i, steps - 1) % len(motor_masks)]
+                set_mask |= step_set
+                clr_mask |= step_clr
+            pulses.append(pigpio.pulse(set_mask, clr_mask, delay_us))
+        try:
+            done = play_wave(pulses, delay_us)
+        except pigpio.error as exc:
+            LOG.debug("Wave zu groß, nutze Software-Timing: %s", exc)
+
+    if done is None:
+        pins = tuple(pin for motor, _, _ in moves for pin in motor.pins)
+        sequences = [(motor.get_sequence(mode, clockwise), steps) for motor, steps, clockwise in moves]
+        schedule = []
+        for i in range(total):
+            values = ()
+            for sequence, steps in sequences:
+                values += sequence[min(i, steps - 1) % len(sequence)]
+            schedule.append(values)
+        done = run_steps(pins, schedule, itertools.repeat(int(delay * 1e9)))
+
+    for motor, steps, clockwise in moves:
+        motor.update_position(min(done, steps), clockwise, mode)
+    if done < total:
+        raise MotionAborted()
+
+
+def move_motors_to_position(motors, position_num, delay=0.005, mode="full"):
+    if position_num not in POSITIONS:
+        return
+
+    plans = [motor.plan_move(position_num, mode) for motor in motors]
+    try:
+        rotate_motors_together(
+            motors,
+            [steps for steps, _ in plans],
+            [clockwise for _, clockwise in plans],
+            delay,
+            mode,
+        )
+    finally:
+        for motor in motors:
+            motor.stop()
 
-def move_motors_simultaneously(motors, action, *args, **kwargs):
-    threads = []
-    for motor in motors:
-        method = getattr(motor, action)
-        t = threading.Thread(target=method, args=args, kwargs=kwargs)
-        threads.append(t)
 
-    for t in threads:
-        t.start()
+def move_motors_to_home(motors, delay=0.005, mode="full"):
+    move_motors_to_position(motors, 0, delay, mode)
 
-    for t in threads:
-        t.join()
 
-    for motor in motors:
-        motor.stop()
+_poll_fd = None
+_pending_keys = []
 
 
-def get_char():
+@contextlib.contextmanager
+def raw_stdin():
+    global _poll_fd
     fd = sys.stdin.fileno()
     old = termios.tcgetattr(fd)
     try:
-        tty.setraw(fd)
-        return sys.stdin.read(1)
+        tty.setcbreak(fd)
+        _poll_fd = fd
+        yield
     finally:
+        _poll_fd = None
         termios.tcsetattr(fd, termios.TCSADRAIN, old)
 
 
+def _read_key(fd):
+    return os.read(fd, 1).decode(errors="replace")
+
+
+def get_char():
+    if _pending_keys:
+        return _pending_keys.pop(0)
+    return _read_key(sys.stdin.fileno())
+
+
+def poll_char():
+    if _poll_fd is None or not select.select([_poll_fd], [], [], 0)[0]:
+        return None
+    return _read_key(_poll_fd)
+
+
+def stop_requested():
+    key = poll_char()
+    if key is None:
+        return False
+    if key.lower() in STOP_KEYS:
+        return True
+    _pending_keys.append(key)
+    return False
+
+
 def Kamera_erkennung():
     print("Starte Kamera und Erkennung...")
 
@@ -178,10 +544,87 @@ def Kamera_erkennung():
     return None
 
 
+def auswurf(motor):
+    motor.rotate_steps(int(200 * motor.gear_ratio), 0.005, True)
+
+
+def handle_camera(cmd, motors, delay):
+    kategorie = Kamera_erkennung()
+    if kategorie:
+        position = Kategorie_zu_Positonen.get(kategorie, 0)
+        print(f" '{kategorie}' → Position {position}")
+        move_motors_to_position(motors, position, delay)
+        print("Warte 1 Sekunde...")
+        time.sleep(1)
+        print("Auswurf...")
+        auswurf(motors[0])
+        time.sleep(1)
+        print("Fahre zurück zur Home-Position...")
+        move_motors_to_home(motors, delay)
+        print("Fertig!")
+    else:
+        print("Keine Kategorie erkannt, Motor bleibt stehen.")
+    return delay
+
+
+def handle_position(cmd, motors, delay):
+    move_motors_to_position(motors, int(cmd), delay)
+    time.sleep(1)
+    auswurf(motors[0])
+    time.sleep(1)
+    move_motors_to_home(motors, delay)
+    return delay
+
+
+def handle_home(cmd, motors, delay):
+    move_motors_to_home(motors, delay)
+    return delay
+
+
+def handle_reset(cmd, motors, delay):
+    for m in motors:
+        m.reset_position()
+    return delay
+
+
+def handle_stop(cmd, motors, delay):
+    for m in motors:
+        m.stop()
+    return delay
+
+
+def handle_print(cmd, motors, delay):
+    for m in motors:
+        print(f"  {m.name}: {m.current_position:.1f}°")
+    return delay
+
+
+def handle_faster(cmd, motors, delay):
+    return max(0.003, delay - 0.001)
+
+
+def handle_slower(cmd, motors, delay):
+    return min(0.020, delay + 0.001)
+
+
+HANDLERS = {
+    "k": handle_camera,
+    "h": handle_home,
+    "r": handle_reset,
+    "s": handle_stop,
+    "p": handle_print,
+    "+": handle_faster,
+    "-": handle_slower,
+    **{c: handle_position for c in "01234"},
+}
+QUIT_KEYS = ("", "q", "\x03")
+
+
 if __name__ == "__main__":
     motor1 = StepperMotor(MOTOR1_PINS, "Motor 1", steps_per_rev=200, gear_ratio=2.0)
     motor2 = StepperMotor(MOTOR2_PINS, "Motor 2", steps_per_rev=200, gear_ratio=2.0)
     motors = [motor1, motor2]
+    lock_memory()
 
     delay = 0.005
 
@@ -190,61 +633,26 @@ if __name__ == "__main__":
           "h=Home,")
 
     try:
-        while True:
-            cmd = get_char().lower()
-            if cmd == "k":
-                kategorie = Kamera_erkennung()
-                if kategorie:
-                    position = Kategorie_zu_Positonen.get(kategorie, 0)
-                    print(f" '{kategorie}' → Position {position}")
-                    move_motors_simultaneously(motors, "move_to_position", position, delay)
-                    print("Warte 1 Sekunde...")
-                    time.sleep(1)
-                    print("Auswurf...")
-                    motor1.rotate_steps(int(200 * motor1.gear_ratio), 0.005, True)
-                    time.sleep(1)
-                    print("Fahre zurück zur Home-Position...")
-                    move_motors_simultaneously(motors, "move_to_home", delay)
-                    print("Fertig!")
-                else:
-                    print("Keine Kategorie erkannt, Motor bleibt stehen.")
-
-            elif cmd in "01234":
-                pos = int(cmd)
-                move_motors_simultaneously(motors, "move_to_position", pos, delay)
-                time.sleep(1)
-                motor1.rotate_steps(int(200 * motor1.gear_ratio), 0.005, True)
-                time.sleep(1)
-                move_motors_simultaneously(motors, "move_to_home", delay)
-
-            elif cmd == "h":
-                move_motors_simultaneously(motors, "move_to_home", delay)
-
-            elif cmd == "r":
-                for m in motors:
-                    m.reset_position()
-
-            elif cmd == "s":
-                for m in motors:
-                    m.stop()
-
-            elif cmd == "p":
-                for m in motors:
-                    print(f"  {m.name}: {m.current_position:.1f}°")
-
-            elif cmd == "+":
-                delay = max(0.003, delay - 0.001)
-
-            elif cmd == "-":
-                delay = min(0.020, delay + 0.001)
-
-            elif cmd in ("q", "\x03"):
-                break
+        with raw_stdin():
+            while True:
+                cmd = get_char().lower()
+                if cmd in QUIT_KEYS:
+                    break
+
+                handler = HANDLERS.get(cmd)
+                if handler is None:
+                    continue
+
+                try:
+                    delay = handler(cmd, motors, delay)
+                except MotionAborted:
+                    for m in motors:
+                        m.stop()
+                    print("Bewegung abgebrochen.")
 
     except KeyboardInterrupt:
         pass
 
     finally:
         for m in motors:
-            m.stop()
-    GPIO.cleanup()
\ No newline at end of file
+            m.stop()
\ No newline at end of file